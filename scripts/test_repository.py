@@ -23,6 +23,9 @@ Usage:
         [--setup-cmd=SETUP_CMD]
         [--cleanup-cmd=SETUP_CMD]
         [--loop-time=MIN_TIME_IN_SEC]
+        [--setup-timeout=SEC] [--checkout-timeout=SEC] [--test-timeout=SEC] [--cleanup-timeout=SEC]
+        [--inactivity-timeout=SEC]
+        [--cpus=CPUS] [--memory=MEMORY]
         [--no-keyring]
         [--dry-run]
     pilz_github_ci_runner.py set-token
@@ -38,6 +41,14 @@ Options:
     --cleanup-cmd=CLEANUP_CMD    Command to run after industrial_ci has finished e.g. for stopping hardware
     --loop-time=MIN_TIME_IN_SEC  If set automatically searches valid pull requests and executes the tests continuosly.
                                  The argument provided is the minimum repeat time of the loop in seconds.
+    --setup-timeout=SEC          Kill the setup command if it runs longer than SEC seconds.
+    --checkout-timeout=SEC       Kill the git commands of the checkout if they take longer than SEC seconds in total.
+    --test-timeout=SEC           Kill industrial_ci and its containers if it runs longer than SEC seconds.
+    --cleanup-timeout=SEC        Kill the cleanup command if it runs longer than SEC seconds.
+    --inactivity-timeout=SEC     Kill any command that does not print anything to stdout or stderr for SEC seconds.
+    --cpus=CPUS                  Limit the CPUs available to the test container (docker --cpus).
+    --memory=MEMORY              Limit the memory available to the test container (docker --memory) e.g. 4g.
+                                 Also sets --memory-swap to the same value, so the container cannot use swap.
     --no-keyring                 Will ask for the token directly, instead of using the keyring.
     --dry-run                    Don't comment on the github pull requests. For testing purposes.
 """
@@ -86,6 +97,20 @@ def parse_ci_args(cias):
     return ci_env
 
 
+def parse_timeout(arguments, option):
+    value = arguments.get(option)
+    return float(value) if value else None
+
+
+def parse_timeouts(arguments):
+    timeouts = {}
+    for phase in ["setup", "checkout", "test", "cleanup"]:
+        timeout = parse_timeout(arguments, f"--{phase}-timeout")
+        if timeout:
+            timeouts[phase] = timeout
+    return timeouts
+
+
 if __name__ == "__main__":
     arguments = docopt.docopt(__doc__)
     print(arguments, "\n")
@@ -104,7 +129,11 @@ if __name__ == "__main__":
                             log_dir=log_dir,
                             setup_cmd=arguments.get("--setup-cmd"),
                             cleanup_cmd=arguments.get("--cleanup-cmd"),
-                            dry_run=arguments.get("--dry-run"))
+                            dry_run=arguments.get("--dry-run"),
+                            timeouts=parse_timeouts(arguments),
+                            inactivity_timeout=parse_timeout(arguments, "--inactivity-timeout"),
+                            cpu_limit=arguments.get("--cpus"),
+                            memory_limit=arguments.get("--memory"))
 
     try:
         check_executor = PRCheckExecutor(
@@ -21,15 +21,29 @@ from .print_redirector import PrintRedirector
 from .output_format import collapse_sections
 import os
 import time
+import codecs
+import contextlib
+import select
+import signal
+import sys
 import subprocess
 import yaml
 
+KILL_GRACE_PERIOD = 10
+DOCKER_LABEL = "pilz_github_ci_runner.run"
+
 
 class HardwareTester(object):
     """ This Class fetches the sources, runs the industrial ci and reports back the result to the PullRequest.
+
+        Every phase (setup, checkout, test, cleanup) can be limited by a wall-clock timeout given in ``timeouts``
+        and all phases by a common ``inactivity_timeout``. A phase exceeding its limit is killed together with its
+        whole process group and the docker containers of the run are removed.
     """
 
-    def __init__(self, token: str, log_dir: str, ci_args: {}, setup_cmd: str, cleanup_cmd: str, dry_run: bool, *args, **kwargs):
+    def __init__(self, token: str, log_dir: str, ci_args: {}, setup_cmd: str, cleanup_cmd: str, dry_run: bool,
+                 timeouts: {} = None, inactivity_timeout: float = None, cpu_limit: str = None,
+                 memory_limit: str = None, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self._token = token
         self._log_dir = log_dir
@@ -37,6 +51,10 @@ class HardwareTester(object):
         self._setup_cmd = setup_cmd
         self._cleanup_cmd = cleanup_cmd
         self._dry_run = dry_run
+        self._timeouts = timeouts or {}
+        self._inactivity_timeout = inactivity_timeout
+        self._cpu_limit = cpu_limit
+        self._memory_limit = memory_limit
 
     def check_prs(self, prs_to_check: Sequence[PullRequest]):
         """ Runs the CI for several PullRequest objects """
@@ -46,34 +64,65 @@ class HardwareTester(object):
     def check_pr(self, pr: PullRequest):
         """ Fetches a PullRequest and runs the industrial CI for it. """
         repo = pr.base.repo
+        run_id = f"{pr.head.sha}_{int(time.time())}"
         print(f"Starting test of PR #{pr.number}")
         if not self._dry_run:
             pr.create_issue_comment(f"Starting a test for {pr.head.sha}")
-        if self._setup_cmd:
-            _run_command(self._setup_cmd)
+        if self._setup_cmd and _timed_out(self._run_phase("setup", self._setup_cmd)):
+            # A hanging bench is no result of the PR, so it is not reported and will be retried in the next run.
+            print(f"Setup timed out, skipping test of PR #{pr.number} for now.")
+            if self._cleanup_cmd:
+                self._run_phase("cleanup", self._cleanup_cmd)
+            return
         with PrintRedirector(Path(self._log_dir) / Path(self._get_log_file_name(pr))):
             with TemporaryDirectory() as t:
-                _run_command(
-                    f"git clone https://{self._token}@github.com/{repo.full_name}.git", cwd=t)
                 repo_dir = os.path.join(t, repo.name)
-                _run_command(
-                    "git config advice.detachedHead false", cwd=repo_dir)
-                _run_command(
-                    f"git fetch origin pull/{pr.number}/merge", cwd=repo_dir)
-                _run_command(
-                    "git checkout FETCH_HEAD", cwd=repo_dir)
-                result = run_tests(
-                    repo_dir, _extend_env_from_config_file(repo_dir, self._env))
-
-        result_msg = "SUCCESSFULL" if not result["return_code"] else "WITH %s FAILURES" % result["return_code"]
-        end_text = f"Finished test of {pr.head.sha}: {result_msg}"
+                checkout_start = time.monotonic()
+                for command, cwd in [
+                        (f"git clone https://{self._token}@github.com/{repo.full_name}.git", t),
+                        ("git config advice.detachedHead false", repo_dir),
+                        (f"git fetch origin pull/{pr.number}/merge", repo_dir),
+                        ("git checkout FETCH_HEAD", repo_dir)]:
+                    result = self._run_phase("checkout", command, started=checkout_start, cwd=cwd)
+                    if _timed_out(result):
+                        break
+                else:
+                    env = _extend_env_from_config_file(repo_dir, self._env)
+                    try:
+                        result = run_tests(repo_dir, self._limit_docker_run(env, run_id),
+                                           timeout=self._timeouts.get("test"),
+                                           inactivity_timeout=self._inactivity_timeout)
+                        result = _add_phase_to_timeout(result, "test")
+                    except BaseException:
+                        _remove_docker_containers(run_id)
+                        raise
+                    if _timed_out(result):
+                        _remove_docker_containers(run_id)
+
+        end_text = f"Finished test of {pr.head.sha}: {_result_message(result)}"
         print(end_text)
 
         co = collapse_sections(result["output"])
         if not self._dry_run:
             pr.create_issue_comment(f"{end_text}\n{co}")
         if self._cleanup_cmd:
-            _run_command(self._cleanup_cmd)
+            self._run_phase("cleanup", self._cleanup_cmd)
+
+    def _run_phase(self, phase: str, command: str, started: float = None, **kwargs):
+        result = _run_command(command, timeout=self._timeouts.get(phase),
+                              inactivity_timeout=self._inactivity_timeout, started=started, **kwargs)
+        return _add_phase_to_timeout(result, phase)
+
+    def _limit_docker_run(self, env: {}, run_id: str) -> {}:
+        """ Labels the containers of this run and applies the cgroup limits via the docker run options. """
+        opts = [env.get("DOCKER_RUN_OPTS", ""), f"--label {DOCKER_LABEL}={run_id}"]
+        if self._cpu_limit:
+            opts.append(f"--cpus={self._cpu_limit}")
+        if self._memory_limit:
+            opts.append(f"--memory={self._memory_limit} --memory-swap={self._memory_limit}")
+        limited_env = env.copy()
+        limited_env["DOCKER_RUN_OPTS"] = " ".join(o for o in opts if o)
+        return limited_env
 
     def _get_log_file_name(self, pr: PullRequest) -> str:
         head_commit = list(pr.get_commits())[-1].sha
@@ -87,22 +136,122 @@ def _gather_ci_environment_variables(ci_args: {}) -> {}:
     return relevant_env
 
 
-def _run_command(command: str, **kwargs):
+def _timed_out(result) -> bool:
+    return result["timeout"] is not None
+
+
+def _add_phase_to_timeout(result, phase: str):
+    if _timed_out(result):
+        result["timeout"] = f"{result['timeout']} during {phase}"
+    return result
+
+
+def _result_message(result) -> str:
+    if _timed_out(result):
+        return f"TIMED OUT ({result['timeout']})"
+    return "SUCCESSFULL" if not result["return_code"] else "WITH %s FAILURES" % result["return_code"]
+
+
+def _run_command(command: str, timeout: float = None, inactivity_timeout: float = None, started: float = None,
+                 **kwargs):
+    """ Runs a shell command in its own process group and prints its output.
+        Only stdout is returned, stderr is forwarded to ``sys.stderr``.
+
+        If more than ``timeout`` seconds passed since ``started`` (a ``time.monotonic()`` value, defaults to the
+        start of the command) or the command does not print anything to stdout or stderr for ``inactivity_timeout``
+        seconds, the whole process group is killed and the reason is returned in the ``timeout`` field.
+    """
     print(f"\n{'>'*50}\nExecuting: {command}\n")
     process = subprocess.Popen(
-        command, stdout=subprocess.PIPE, shell=True, **kwargs)
-    full_output = ""
-    while True:
-        output = process.stdout.readline().decode()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            full_output += output
-            print(output.strip())
-
-    return_code = process.poll()
+        command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=True, **kwargs)
+    streams = {process.stdout: _OutputStream(lambda line: print(line.strip())),
+               process.stderr: _OutputStream(lambda line: print(line.rstrip(), file=sys.stderr))}
+    last_output = time.monotonic()
+    start = last_output if started is None else started
+    timed_out = None
+    try:
+        while True:
+            now = time.monotonic()
+            if timeout and now - start >= timeout:
+                timed_out = f"exceeded {timeout}s"
+            elif inactivity_timeout and now - last_output >= inactivity_timeout:
+                timed_out = f"no output for {inactivity_timeout}s"
+            if timed_out:
+                print(f"\nCommand timed out: {timed_out}. Killing it.")
+                _kill_process_group(process)
+                break
+            wait = min([1] + [limit - (now - since) for limit, since in
+                              [(timeout, start), (inactivity_timeout, last_output)] if limit])
+            open_pipes = [pipe for pipe, stream in streams.items() if stream.open]
+            if not open_pipes:
+                # The command may close its output and keep running, so the limits still apply until it exits.
+                with contextlib.suppress(subprocess.TimeoutExpired):
+                    process.wait(wait)
+                    break
+                continue
+            ready, _, _ = select.select(open_pipes, [], [], wait)
+            for pipe in ready:
+                if streams[pipe].read(pipe):
+                    last_output = time.monotonic()
+    except BaseException:
+        # e.g. a KeyboardInterrupt, which does not reach the command in its own session
+        _kill_process_group(process)
+        raise
+    for pipe, stream in streams.items():
+        stream.flush()
+        pipe.close()
+
+    return_code = process.wait()
     print("<"*50)
-    return {"return_code": return_code, "output": full_output}
+    return {"return_code": return_code, "output": streams[process.stdout].output, "timeout": timed_out}
+
+
+class _OutputStream(object):
+    """ Collects the output of a pipe and passes it on line by line. """
+
+    def __init__(self, print_line):
+        self._print_line = print_line
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._pending = ""
+        self.output = ""
+        self.open = True
+
+    def read(self, pipe) -> bool:
+        chunk = os.read(pipe.fileno(), 4096)
+        if not chunk:
+            self.open = False
+            return False
+        output = self._decoder.decode(chunk)
+        self.output += output
+        *lines, self._pending = (self._pending + output).split("\n")
+        for line in lines:
+            self._print_line(line)
+        return True
+
+    def flush(self):
+        if self._pending:
+            self._print_line(self._pending)
+            self._pending = ""
+
+
+def _kill_process_group(process: subprocess.Popen):
+    """ Terminates the whole process group and kills whatever is left of it after the grace period. """
+    deadline = time.monotonic() + KILL_GRACE_PERIOD
+    with contextlib.suppress(ProcessLookupError):
+        os.killpg(process.pid, signal.SIGTERM)
+        while time.monotonic() < deadline:
+            process.poll()
+            os.killpg(process.pid, 0)
+            time.sleep(0.1)
+        os.killpg(process.pid, signal.SIGKILL)
+
+
+def _remove_docker_containers(run_id: str):
+    containers = subprocess.run(["docker", "ps", "-aq", "--filter", f"label={DOCKER_LABEL}={run_id}"],
+                                stdout=subprocess.PIPE, universal_newlines=True).stdout.split()
+    if containers:
+        print(f"Removing containers of aborted run: {' '.join(containers)}")
+        subprocess.run(["docker", "rm", "-f"] + containers, stdout=subprocess.DEVNULL)
 
 
 def _extend_env_from_config_file(repo_dir, env: {}) -> {}:
@@ -118,12 +267,15 @@ def _extend_env_from_config_file(repo_dir, env: {}) -> {}:
     return extended_env
 
 
-def run_tests(dir, env: {}):
+def run_tests(dir, env: {}, timeout: float = None, inactivity_timeout: float = None):
     """ Runs the industrial CI on a ros package directory.
         Needs ROS and industrial CI sourced.
 
         :param dir: Path to the ros package to test
+        :param timeout: Maximum runtime in seconds
+        :param inactivity_timeout: Maximum time in seconds without any output
     """
     command = 'rosrun industrial_ci run_ci'
     print('Running {}'.format(command))
-    return _run_command(command, env=env, cwd=os.path.expanduser(dir))
+    return _run_command(command, timeout=timeout, inactivity_timeout=inactivity_timeout,
+                        env=env, cwd=os.path.expanduser(dir))